@@ -1,224 +1,477 @@
 import argparse
+import collections
+import concurrent.futures
 import logging, logging.handlers
 import os
 import tempfile
 import yaml
 import boto3, botocore
+import botocore.config
 import datetime
+import functools
+import json
+import random
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows - rate limiting is then per process only
+    fcntl = None
 
 logging.getLogger("botocore").setLevel(logging.CRITICAL)
 
-KEEP_LIST = []
+# Only needed to read .yaml backups from older versions - prefer libyaml if
+# PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Route 53 limits for a single ChangeResourceRecordSets request
+MAX_BATCH_CHANGES = 1000
+MAX_BATCH_VALUE_CHARS = 32000
+
+# Largest page sizes the Route 53 list APIs will return
+MAX_HOSTED_ZONES_PAGE_SIZE = 100
+MAX_RECORDS_PAGE_SIZE = 300
+
+# Adaptive mode retries throttling errors (including Throttling and
+# PriorRequestNotComplete) with jittered exponential backoff, and rate limits
+# the client itself once it starts seeing them
+R53_MAX_ATTEMPTS = 10
+# Keep connections open and pooled so a run reuses the same HTTPS connection(s)
+R53_CLIENT_CONFIG = botocore.config.Config(
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=30,
+    retries={'total_max_attempts': R53_MAX_ATTEMPTS, 'mode': 'adaptive'}
+)
+
+# Route 53 allows 5 requests per second per account - stay below that to leave
+# room for the console and anything else using the same account
+R53_REQUESTS_PER_SECOND = 3.0
+R53_BURST = 5
+MAX_ZONE_WORKERS = 5
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'r53_record_cleanup')
+R53_RATE_LIMIT_FILE = os.path.join(CACHE_DIR, 'ratelimit')
+
+
+class TokenBucket(object):
+    """
+    Simple token bucket rate limiter. If lock_path is given the bucket state is
+    kept in that file (guarded by flock) so separate processes share the limit.
+    """
+
+    def __init__(self, rate=R53_REQUESTS_PER_SECOND, capacity=R53_BURST, lock_path=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.lock_path = lock_path if fcntl else None
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens, last, now):
+        # Returns the new (tokens, last) state and how long to wait before retrying.
+        # The clock may have gone backwards (e.g. a shared state file written
+        # before a clock change) so never refill by a negative amount.
+        tokens = max(0.0, min(self.capacity, tokens + max(0.0, now - last) * self.rate))
+        if tokens >= 1:
+            return tokens - 1, now, 0
+        return tokens, now, (1 - tokens) / self.rate
+
+    def _take_shared(self):
+        # The state file is shared between processes, so it holds wall clock
+        # time - monotonic time isn't comparable across reboots
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        with os.fdopen(fd, 'r+') as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                try:
+                    tokens, last = [float(x) for x in state_file.read().split()]
+                except ValueError:
+                    tokens, last = float(self.capacity), now
+                tokens, last, wait = self._take(tokens, last, now)
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write('%f %f' % (tokens, last))
+            finally:
+                fcntl.flock(state_file, fcntl.LOCK_UN)
+        return wait
+
+    def acquire(self):
+        """Block until a request may be made"""
+        while True:
+            with self._lock:
+                if self.lock_path:
+                    try:
+                        wait = self._take_shared()
+                    except (IOError, OSError) as e:
+                        logging.warning('Unable to use shared rate limit file %s: %s', self.lock_path, e)
+                        self.lock_path = None
+                        continue
+                else:
+                    self._tokens, self._last, wait = self._take(self._tokens, self._last, time.monotonic())
+            if wait <= 0:
+                return
+            time.sleep(wait)
 
 
-def expand_keep_list(zone_name):
-    if not zone_name.endswith('.'):
-        zone_name += '.'
-    KEEP_LIST[:] = [x + '.' + zone_name for x in KEEP_LIST]
+R53_RATE_LIMITER = TokenBucket(lock_path=R53_RATE_LIMIT_FILE)
 
 
-def get_hosted_zone_list(profile=None):
+def _r53_rate_limit(**kwargs):
+    # Runs before every HTTP request - each page fetched by a paginator and
+    # each retry attempt takes its own token
+    R53_RATE_LIMITER.acquire()
+
+
+def _get_r53_client(profile=None):
+    # Always pass profile positionally so _get_r53_client() and
+    # _get_r53_client(None) share one cache entry
+    return _r53_client_for_profile(profile)
+
+
+@functools.lru_cache(maxsize=None)
+def _r53_client_for_profile(profile):
+    # One session/client per profile - avoids reloading the service model and
+    # re-negotiating TLS on every call
     session = boto3.session.Session(profile_name=profile)
-    r53_client = session.client('route53')
+    r53_client = session.client('route53', config=R53_CLIENT_CONFIG)
+    r53_client.meta.events.register('before-send.route53', _r53_rate_limit)
+    return r53_client
+
+
+def _prime_dns(r53_client):
+    # Resolve the endpoint once up front so the first API call doesn't wait on DNS
+    host = urlparse(r53_client.meta.endpoint_url).hostname
+    try:
+        socket.getaddrinfo(host, 443)
+    except socket.gaierror as e:
+        logging.warning('Unable to resolve %s: %s', host, e)
+
+
+def _fqdn(name):
+    return name if name.endswith('.') else name + '.'
+
+
+def _build_keep_set(raw_list, zone_fqdn):
+    # Entries which are already fully qualified are left alone
+    suffix = '.' + zone_fqdn
+    return frozenset(x if x.endswith(suffix) else x + zone_fqdn for x in (_fqdn(x) for x in raw_list))
+
+
+def get_hosted_zone_list(profile=None):
+    r53_client = _get_r53_client(profile)
     result = None
     try:
-        query = r53_client.list_hosted_zones()
-        result = query['HostedZones']
+        zones = []
+        paginator = r53_client.get_paginator('list_hosted_zones')
+        for page in paginator.paginate(PaginationConfig={'PageSize': MAX_HOSTED_ZONES_PAGE_SIZE}):
+            zones.extend(page['HostedZones'])
+        result = zones
     except botocore.exceptions.ClientError as e:
-        logging.error('Unexpected error: %s' % e)
+        logging.error('Unexpected error: %s', e)
     return result
 
 
-def get_hosted_zone_by_name(zone_name, profile=None):
-    session = boto3.session.Session(profile_name=profile)
-    r53_client = session.client('route53')
+def get_hosted_zone_by_name(zone_name, profile=None, r53_client=None):
+    r53_client = r53_client or _get_r53_client(profile)
     result = None
-    if not zone_name.endswith('.'):
-        zone_name += '.'
-    zone_list = get_hosted_zone_list(profile=profile)
-    if zone_list:
-        for zone in zone_list:
-            if zone_name == zone['Name']:
-                try:
-                    query = r53_client.get_hosted_zone(Id=zone['Id'])
-                    result = query['HostedZone']
-                    break
-                except botocore.exceptions.ClientError as e:
-                    if e.response['Error']['Code'] == 'NoSuchHostedZone':
-                        logging.error("Zone does not exist")
-                    else:
-                        logging.error('Unexpected error: %s' % e)
+    try:
+        # Zones are returned in name order starting at DNSName, so only the
+        # first one can be an exact match
+        query = r53_client.list_hosted_zones_by_name(DNSName=zone_name, MaxItems='1')
+        zones = query['HostedZones']
+        if zones and zones[0]['Name'] == zone_name:
+            result = zones[0]
+    except botocore.exceptions.ClientError as e:
+        logging.error('Unexpected error: %s', e)
     return result
 
 
-def get_all_records_in_zone(zone_id, profile=None):
-    session = boto3.session.Session(profile_name=profile)
-    r53_client = session.client('route53')
+def get_all_records_in_zone(zone_id, profile=None, r53_client=None):
+    r53_client = r53_client or _get_r53_client(profile)
     resource_record_sets = []
     try:
-        current_set = r53_client.list_resource_record_sets(HostedZoneId=zone_id)
-        resource_record_sets.extend(current_set['ResourceRecordSets'])
-        isTruncated = current_set['IsTruncated']
-        while isTruncated:
-            start_name = current_set['NextRecordName']
-            current_set = r53_client.list_resource_record_sets(HostedZoneId=zone_id, StartRecordName=start_name)
-            resource_record_sets.extend(current_set['ResourceRecordSets'])
-            isTruncated = current_set['IsTruncated']
+        paginator = r53_client.get_paginator('list_resource_record_sets')
+        for page in paginator.paginate(HostedZoneId=zone_id, PaginationConfig={'PageSize': MAX_RECORDS_PAGE_SIZE}):
+            resource_record_sets.extend(page['ResourceRecordSets'])
     except botocore.exceptions.ClientError as e:
-        logging.error('Unexpected error: %s' % e)
+        logging.error('Unexpected error: %s', e)
     return resource_record_sets
 
 
-def restore_deleted_records(file_path):
-    session = boto3.session.Session()
-    r53_client = session.client('route53')
+class ChangeBatchError(Exception):
+    """
+    A change batch was rejected. remaining_records holds the records from that
+    batch onwards which were not applied.
+    """
+
+    def __init__(self, cause, remaining_records):
+        super(ChangeBatchError, self).__init__(str(cause))
+        self.cause = cause
+        self.remaining_records = remaining_records
+
+
+class MissingOwningZoneError(ChangeBatchError):
+    """
+    A record has no owning hosted zone recorded and no default zone was given.
+    remaining_records holds every record which had not been submitted yet.
+    """
+
+    def __init__(self, record_name, remaining_records):
+        message = 'No hosted zone recorded for %s - it was written by an older version' % record_name
+        super(MissingOwningZoneError, self).__init__(message, remaining_records)
+
+
+def _iter_records(file_path):
+    # Backups are JSON lines so they can be read a record at a time
+    with open(file_path, 'r') as record_file:
+        for line in record_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _load_records(file_path):
+    if file_path.endswith('.yaml'):
+        # Backups written by older versions of this script
+        with open(file_path, 'r') as record_file:
+            return yaml.load(record_file, YAML_LOADER) or []
+    return _iter_records(file_path)
+
+
+def _write_records(records, output_file):
+    for record in records:
+        json.dump(record, output_file)
+        output_file.write('\n')
+
+
+def restore_deleted_records(file_path, r53_client=None, default_zone_id=None):
+    r53_client = r53_client or _get_r53_client()
 
     if not os.path.exists(file_path):
         logging.critical('Invalid file path provided')
         exit(1)
-    else:
-        records = []
-        with open(file_path, 'r') as record_file:
-            records = yaml.load(record_file, yaml.SafeLoader)
 
     logging.info('Restoring records...')
-
-    # Loop through all records, creating change sets of 50 records at a time
-    number_of_records = len(records)
-    start_record = 0
-    records_processed = 0
-    batch_size = 100
-    while records_processed < number_of_records:
-        change_set = []
-        # Get the next <batch_size> records - if they exist
-        end_record = start_record + batch_size
-        if end_record > number_of_records:
-            end_record = number_of_records
-        records_to_process = records[start_record:end_record:1]
-        zone_id = records_to_process[0]['AliasTarget']['HostedZoneId']
-        for record in records_to_process:
-            resource_record_set = {
-                'AliasTarget': {
-                    'HostedZoneId': record['AliasTarget']['HostedZoneId'],
-                    'EvaluateTargetHealth': record['AliasTarget']['EvaluateTargetHealth'],
-                    'DNSName': record['AliasTarget']['DNSName']
-                },
-                'Type': record['Type'],
-                'Name': record['Name']
-            }
-            change = {'Action': 'UPSERT', 'ResourceRecordSet': resource_record_set}
-            change_set.append(change)
-        change_batch = {'Comment' : 'Restoring resource records', 'Changes' : change_set}
-        try:
-            logging.debug("Attempting the following changes: %s" % change_batch )
-            r53_client.change_resource_record_sets(HostedZoneId=zone_id, ChangeBatch=change_batch)
-            logging.debug("Route53 Change Resource Record request received successfully")
-        except botocore.exceptions.ClientError as e:
-            logging.error("Received error:  %s" % (e))
-            exit(1)
-        records_processed += (end_record-start_record)
-        start_record = end_record
+    # Read and submit the file a batch at a time rather than loading it all
+    zone_batches = _zone_batches(_load_records(file_path), _batch_size('UPSERT'), default_zone_id)
+    # Each zone's records arrive in several chunks - keep numbering its batches across them
+    batches_submitted = collections.Counter()
+    try:
+        for zone_id, zone_records in zone_batches:
+            batches_submitted[zone_id] += _submit_change_batches(zone_id, zone_records, 'UPSERT',
+                                                                 'Restoring resource records', r53_client,
+                                                                 first_batch_index=batches_submitted[zone_id])
+    except ChangeBatchError as e:
+        e.remaining_records.extend(record for _, zone_records in zone_batches for record in zone_records)
+        remaining_path = _save_remaining_records(e.remaining_records, file_path)
+        logging.error('%d records were not restored - they have been written to "%s"',
+                      len(e.remaining_records), remaining_path)
+        if isinstance(e, MissingOwningZoneError):
+            logging.error('To restore them, pass the zone they belong to: --restore %s --hosted-zone <zone>',
+                          remaining_path)
+        else:
+            logging.error('To retry just those records, use --restore %s', remaining_path)
+        raise
     logging.info('Record restoration initiated - check AWS Console to make sure it completed.')
 
 
-
-def delete_records(zone_id, record_list):
-    session = boto3.session.Session()
-    r53_client = session.client('route53')
-
-    # Loop through all records, creating change sets of 50 records at a time
-    number_of_records = len(record_list)
-    logging.debug('There are %d records to delete' % number_of_records)
-    start_record = 0
+def delete_records(record_list, backup_path, r53_client=None):
+    r53_client = r53_client or _get_r53_client()
+    logging.debug('There are %d records to delete', len(record_list))
+    try:
+        _submit_zone_changes(_group_by_owning_zone(record_list), 'DELETE', 'Deleting resource records', r53_client)
+    except ChangeBatchError as e:
+        # These records were not deleted and still exist in Route 53
+        remaining_path = _save_remaining_records(e.remaining_records, backup_path)
+        logging.error('%d records were not deleted and still exist - they have been written to "%s"',
+                      len(e.remaining_records), remaining_path)
+        logging.error('To restore the records which were deleted, use --restore %s', backup_path)
+        raise
+
+
+def _owning_zone_id(record, default_zone_id=None):
+    # Files written by older versions don't record the zone, and the alias
+    # target's zone is not the zone the record lives in - so no guessing
+    return record.get('_OwningZoneId', default_zone_id)
+
+
+def _group_by_owning_zone(records, default_zone_id=None):
+    grouped = collections.defaultdict(list)
+    for record in records:
+        zone_id = _owning_zone_id(record, default_zone_id)
+        if zone_id is None:
+            # Nothing has been submitted yet
+            raise MissingOwningZoneError(record['Name'], list(records))
+        grouped[zone_id].append(record)
+    return grouped
+
+
+def _zone_batches(records, batch_size, default_zone_id=None):
+    # Like _group_by_owning_zone, but yields (zone_id, records) as soon as a
+    # zone has a full batch so at most one batch per zone is held in memory
+    pending = collections.defaultdict(list)
+    records = iter(records)
+    for record in records:
+        zone_id = _owning_zone_id(record, default_zone_id)
+        if zone_id is None:
+            # Earlier batches may already be submitted - hand back everything else
+            unsubmitted = [r for zone_records in pending.values() for r in zone_records]
+            unsubmitted.append(record)
+            unsubmitted.extend(records)
+            raise MissingOwningZoneError(record['Name'], unsubmitted)
+        pending[zone_id].append(record)
+        if len(pending[zone_id]) >= batch_size:
+            yield zone_id, pending.pop(zone_id)
+    for zone_id, zone_records in pending.items():
+        yield zone_id, zone_records
+
+
+def _remaining_records_path(backup_path):
+    return os.path.splitext(backup_path)[0] + '.remaining.jsonl'
+
+
+def _save_remaining_records(remaining, backup_path):
+    # Save the records a failed run didn't get to, returning where they went
+    remaining_path = _remaining_records_path(backup_path)
+    with open(remaining_path, 'w') as output_file:
+        _write_records(remaining, output_file)
+    return remaining_path
+
+
+def _submit_zone_changes(grouped, action, comment, r53_client):
+    # Zones are independent so submit them in parallel - batches within a zone
+    # stay sequential as Route 53 rejects overlapping changes to one zone.
+    # The shared rate limiter keeps the overall request rate in bounds.
+    if not grouped:
+        return
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(MAX_ZONE_WORKERS, len(grouped))) as executor:
+        futures = [executor.submit(_submit_change_batches, zone_id, zone_records, action, comment, r53_client)
+                   for zone_id, zone_records in grouped.items()]
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception():
+                errors.append(future.exception())
+
+    if errors:
+        batch_errors = [e for e in errors if isinstance(e, ChangeBatchError)]
+        if len(batch_errors) < len(errors):
+            raise next(e for e in errors if not isinstance(e, ChangeBatchError))
+        remaining = [record for e in batch_errors for record in e.remaining_records]
+        raise ChangeBatchError(batch_errors[0].cause, remaining)
+
+
+def _record_value_chars(record):
+    # Characters counted against the per-request limit on Value elements -
+    # alias records have none
+    return sum(len(rr['Value']) for rr in record.get('ResourceRecords', []))
+
+
+def _change_batches(records, action):
+    # Yield lists of at most _batch_size(action) records, flushing early if a
+    # batch would go over the Value character limit. A single greedy pass, so
+    # a character split doesn't leave a small batch behind on its own.
+    batch_size = _batch_size(action)
+    value_chars_limit = _batch_value_chars(action)
+    batch = []
+    batch_chars = 0
+    for record in records:
+        record_chars = _record_value_chars(record)
+        if batch and (len(batch) >= batch_size or batch_chars + record_chars > value_chars_limit):
+            yield batch
+            batch = []
+            batch_chars = 0
+        batch.append(record)
+        batch_chars += record_chars
+    if batch:
+        yield batch
+
+
+def _batch_size(action):
+    # UPSERTs count double against the per-request change limit
+    if action == 'UPSERT':
+        return MAX_BATCH_CHANGES // 2
+    return MAX_BATCH_CHANGES
+
+
+def _batch_value_chars(action):
+    # UPSERT Values count double against the character limit too
+    if action == 'UPSERT':
+        return MAX_BATCH_VALUE_CHARS // 2
+    return MAX_BATCH_VALUE_CHARS
+
+
+def _submit_change_batches(zone_id, records, action, comment, r53_client, first_batch_index=0):
+    # Returns the number of batches submitted
     records_processed = 0
-    batch_size = 100
-    while records_processed < number_of_records:
-        change_set = []
-        # Get the next <batch_size> records - if they exist
-        end_record = start_record + batch_size
-        if end_record > number_of_records:
-            end_record = number_of_records
-        logging.debug('processing records %d to %d' % (start_record, end_record))
-        records_to_process = record_list[start_record:end_record:1]
-        logging.debug('%s' % records_to_process)
-        for record in records_to_process:
-            resource_record_set = {
-                'AliasTarget': {
-                    'HostedZoneId': record['AliasTarget']['HostedZoneId'],
-                    'EvaluateTargetHealth': record['AliasTarget']['EvaluateTargetHealth'],
-                    'DNSName': record['AliasTarget']['DNSName']
-                },
-                'Type': record['Type'],
-                'Name': record['Name']
-            }
-            change = {'Action': 'DELETE', 'ResourceRecordSet': resource_record_set}
-            change_set.append(change)
-        change_batch = {'Comment' : 'Deleting resource records', 'Changes' : change_set}
+    batches_submitted = 0
+    for records_to_process in _change_batches(records, action):
+        batch_index = first_batch_index + batches_submitted
+        logging.debug('processing records %d to %d', records_processed, records_processed + len(records_to_process))
+        logging.debug('%s', records_to_process)
+        # Keys starting with _ are our own bookkeeping, everything else is sent as is
+        change_set = [
+            {'Action': action, 'ResourceRecordSet': {k: v for k, v in record.items() if not k.startswith('_')}}
+            for record in records_to_process
+        ]
+        change_batch = {'Comment' : comment, 'Changes' : change_set}
         try:
-            logging.debug("Attempting the following changes: %s" % change_batch )
+            logging.info('Submitting batch %d (%d records) to zone %s', batch_index, len(records_to_process), zone_id)
+            logging.debug("Attempting the following changes: %s", change_batch)
             r53_client.change_resource_record_sets(HostedZoneId=zone_id, ChangeBatch=change_batch)
             logging.debug("Route53 Change Resource Record request received successfully")
-        except botocore.exceptions.ClientError as e:
-            logging.error("Received error:  %s" % (e))
-            exit(1)
-        records_processed += (end_record-start_record)
-        start_record = end_record
+        except (botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+            logging.error("Received error:  %s", e)
+            raise ChangeBatchError(e, list(records[records_processed:]))
+        records_processed += len(records_to_process)
+        batches_submitted += 1
+    return batches_submitted
 
 
-def r53_cleanup(zone_name, target_alias, dryrun=False):
-    zone = get_hosted_zone_by_name(zone_name)
+def r53_cleanup(zone_name, target_alias, keep_set=frozenset(), dryrun=False, r53_client=None):
+    r53_client = r53_client or _get_r53_client()
+    zone = get_hosted_zone_by_name(zone_name, r53_client=r53_client)
     if zone:
         zone_id = zone['Id']
-        record_set = get_all_records_in_zone(zone['Id'])
+        record_set = get_all_records_in_zone(zone['Id'], r53_client=r53_client)
         logging.debug(record_set)
 
-        if not target_alias.endswith('.'):
-            target_alias += '.'
-
-        to_delete=[]
-        for record in record_set:
-            record_name = record['Name']
-            record_type = record['Type']
-            if record_type == 'A':
-                if record_name == zone['Name']:
-                    logging.debug('Skipping %s because it is the zone being searched' % record_name)
-                    continue
-                if record_name not in KEEP_LIST:
-                    if 'AliasTarget' in record:
-                        dns_name = record['AliasTarget']['DNSName']
-                        if dns_name == target_alias:
-                            logging.debug(' To Be Deleted: %s' % record['Name'])
-                            to_delete.append(record)
-                        else:
-                            logging.debug("Skipping %s because Alias Target doesn't match" % record_name)
-                    else:
-                        logging.debug("Skipping %s because it does't have an Alias Target" % record_name)
-                else:
-                    logging.debug('Skipping %s because it is in the KEEP_LIST' % record_name)
-            else:
-                logging.debug('Skipping %s due to incorrect record type (%s)' % (record_name, record_type))
-
-        temp_file = tempfile.NamedTemporaryFile(delete=False)
+        zone_name = zone['Name']
+        # Keep the whole record - routing policy fields (SetIdentifier, Weight,
+        # Region, Failover, ...) are needed to delete and later restore it
+        to_delete = [
+            dict(record, _OwningZoneId=zone_id)
+            for record in record_set
+            if record['Type'] == 'A' and record['Name'] != zone_name
+            and record['Name'] not in keep_set
+            and record.get('AliasTarget', {}).get('DNSName') == target_alias
+        ]
+
+        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.jsonl', mode='w')
         with temp_file as output_file:
-            yaml.safe_dump(to_delete, output_file)
-        temp_file_yaml = temp_file.name + '.yaml'
-        os.rename(temp_file.name, temp_file_yaml)
-        logging.info('Records to be deleted written to "%s"' % temp_file_yaml)
+            _write_records(to_delete, output_file)
+        backup_path = temp_file.name
+        logging.info('Records to be deleted written to "%s"', backup_path)
 
         deleted_record_count = len(to_delete)
         # Now actually delete them
-        logging.info("Found %d records to be deleted" % deleted_record_count)
+        logging.info("Found %d records to be deleted", deleted_record_count)
         if not dryrun:
             logging.info('Deleting records...')
             logging.info(str(datetime.datetime.now()))
-            delete_records(zone_id, to_delete)
+            delete_records(to_delete, backup_path, r53_client)
             logging.info(str(datetime.datetime.now()))
             logging.info('Record deletion complete (or pending) - check AWS Console to make sure things are as expected.')
-            logging.info('To restore these records, use --restore %s' % temp_file_yaml)
+            logging.info('To restore these records, use --restore %s', backup_path)
         else:
             logging.info('dryrun selected - no records deleted')
     else:
-        logging.error('Unable to find zone with name %s' % zone_name)
+        logging.error('Unable to find zone with name %s', zone_name)
 
 
 
@@ -236,10 +489,14 @@ if __name__ == "__main__":
 
     parser.add_argument("--aws-access-key-id", help="AWS Access Key ID", dest='aws_access_key', required=False)
     parser.add_argument("--aws-secret-access-key", help="AWS Secret Access Key", dest='aws_secret_key', required=False)
-    parser.add_argument("--hosted-zone", help="Hosted Zone Name", dest='zone_name', required=False)
+    parser.add_argument("--hosted-zone", help="Hosted Zone Name (with --restore, the zone for records\n"
+                                             "in backups written by older versions)",
+                        dest='zone_name', required=False)
     parser.add_argument("--target-alias", help="Target Alias", dest='target_alias', required=False)
     parser.add_argument("--keep-list", help="Add to the keep list", dest='keep_list', nargs='+', required=False)
     parser.add_argument("--restore", help="Restore deleted records", dest='restore_file', required=False)
+    parser.add_argument("--jitter-seconds", help="Wait a random time of up to this many seconds before starting",
+                        dest='jitter_seconds', type=float, default=0, required=False)
     parser.add_argument("--verbose", help="Turn on DEBUG logging", action='store_true', required=False)
     parser.add_argument("--dryrun", help="Do a dryrun - no changes will be performed", dest='dryrun',
                         action='store_true', default=False,
@@ -287,7 +544,11 @@ if __name__ == "__main__":
     logging.debug('INIT')
 
     if args.restore_file:
-        restore_deleted_records(args.restore_file)
+        if not os.path.exists(args.restore_file):
+            logging.critical('Invalid file path provided')
+            exit(1)
+        if args.zone_name:
+            args.zone_name = _fqdn(args.zone_name)
     else:
         if not args.zone_name:
             logging.critical('Must provide a zone_name to search')
@@ -297,19 +558,45 @@ if __name__ == "__main__":
             logging.critical('Must provide a target_alias')
             exit(1)
 
-        logging.info('Cleaning up Route 53 records in Hosted Zone %s with a target alias of %s' % (args.zone_name, args.target_alias))
+        args.zone_name = _fqdn(args.zone_name)
+        args.target_alias = _fqdn(args.target_alias)
 
-        if args.keep_list:
-            logging.info("Adding the following to the keep list: %s" % args.keep_list)
-            for item in args.keep_list:
-                KEEP_LIST.append(item.replace('*', "\\052"))
+    if args.jitter_seconds > 0:
+        # Spread out runs scheduled at the same time against the same account
+        jitter = random.uniform(0, args.jitter_seconds)
+        logging.info('Waiting %.2f seconds before starting', jitter)
+        time.sleep(jitter)
 
-        if len(KEEP_LIST) > 0:
-            expand_keep_list(args.zone_name)
+    # Create the client up front so loading the AWS config and service model
+    # doesn't land in the middle of the timed work below
+    r53_client = _get_r53_client()
+    _prime_dns(r53_client)
 
-        logging.info("Records matching the following keep list will NOT be removed:")
-        for item in KEEP_LIST:
-            logging.info("   %s" % item)
+    try:
+        if args.restore_file:
+            default_zone_id = None
+            if args.zone_name:
+                zone = get_hosted_zone_by_name(args.zone_name, r53_client=r53_client)
+                if not zone:
+                    logging.critical('Unable to find zone with name %s', args.zone_name)
+                    exit(1)
+                default_zone_id = zone['Id']
+            restore_deleted_records(args.restore_file, r53_client, default_zone_id)
+        else:
+            logging.info('Cleaning up Route 53 records in Hosted Zone %s with a target alias of %s', args.zone_name, args.target_alias)
 
-        r53_cleanup(args.zone_name, args.target_alias, args.dryrun)
+            keep_list = []
+            if args.keep_list:
+                logging.info("Adding the following to the keep list: %s", args.keep_list)
+                keep_list = [item.replace('*', "\\052") for item in args.keep_list]
+            keep_set = _build_keep_set(keep_list, args.zone_name)
+
+            logging.info("Records matching the following keep list will NOT be removed:")
+            for item in sorted(keep_set):
+                logging.info("   %s", item)
+
+            r53_cleanup(args.zone_name, args.target_alias, keep_set, args.dryrun, r53_client)
+    except (ChangeBatchError, botocore.exceptions.ClientError, botocore.exceptions.BotoCoreError) as e:
+        logging.critical('Unable to complete: %s', e)
+        exit(1)
     logging.info('COMPLETE')